@@ -1,30 +1,181 @@
+import asyncio
+import math
 import os
+import sys
 import time
 import json
-from datetime import datetime, timezone
-from typing import Dict, Any, Set
-
+import logging
+import queue
+import threading
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Any, FrozenSet, List, Optional, Set, Tuple
+
+import aiohttp
+import numpy as np
+import orjson
+import requests
+from binance import AsyncClient, ThreadedWebsocketManager
 from binance.client import Client
-from binance.exceptions import BinanceAPIException
+from binance.exceptions import BinanceAPIException, BinanceRequestException
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# HTTP/2 is optional: without httpx (and h2) the REST clients stay on
+# keep-alive HTTP/1.1
+try:
+    import h2  # noqa: F401
+    import httpx
+except ImportError:
+    httpx = None
 
 CONFIG_FILE = "config.json"
 STATE_FILE = "state.json"
 STATUS_FILE = "status.json"
+MARKETS_FILE = "markets.json"
+# step sizes are re-read from exchangeInfo once they are this old (seconds)
+MARKETS_TTL = 24 * 3600
+# a LOT_SIZE reject re-reads them early, but not more often than this (seconds)
+MARKETS_RETRY = 3600
+
+# Binance spot default taker fee, used to estimate sell proceeds when the
+# order response carries no fills
+TAKER_FEE = 0.001
+# up to this many symbols are requested by name; beyond it, fetch every ticker
+BULK_SYMBOL_LIMIT = 20
+# Binance spot REQUEST_WEIGHT budget per minute, and the share of it at which
+# the loop stops early cycles until the next minute window
+WEIGHT_LIMIT_1M = 6000
+WEIGHT_RESERVE = 0.8
+# python-binance base_endpoint values: api.binance.com and its api1-api4 mirrors
+API_ENDPOINTS = ("", "1", "2", "3", "4")
 
 load_dotenv()
 
 API_KEY = os.getenv("BINANCE_API_KEY")
 API_SECRET = os.getenv("BINANCE_API_SECRET")
+# BOT_VERBOSE=1 logs the full block for every pair, not only the ones that fire
+VERBOSE = os.getenv("BOT_VERBOSE", "0") == "1"
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class PairSpec:
+    name: str
+    coin_a: str
+    coin_b: str
+    sym_a: str
+    sym_b: str
+    upper: float
+    lower: float
+    alloc: float
+
+
+@dataclass(frozen=True, slots=True)
+class ArmedTrigger:
+    # what the stream callback needs to project a pair's ratio EMA exactly as
+    # evaluate_pairs would, and the threshold that EMA has to cross
+    sym_a: str
+    sym_b: str
+    threshold: float
+    fire_above: bool
+    ema: float
+    ema_ts: float
+    alpha: float
+    interval: float
+
+
+# last prices pushed by the per-symbol miniTicker streams, keyed by symbol
+PRICE_CACHE: Dict[str, float] = {}
+PRICE_LOCK = threading.Lock()
+# monotonic time each symbol's price was last updated, by its stream or REST;
+# one silent symbol must not ride on the others' freshness
+PRICE_TS: Dict[str, float] = {}
+# the multiplex socket currently feeding PRICE_CACHE and the symbols it covers
+_PRICE_SOCKET: Dict[str, Any] = {"name": None, "symbols": frozenset()}
+
+# set to cut the main loop's sleep short, e.g. when a ratio crosses its threshold
+WAKE = threading.Event()
+# pair name -> trigger for pairs able to trade; the stream callback wakes the
+# loop when the pair's projected ratio EMA crosses the threshold
+_ARMED: Dict[str, ArmedTrigger] = {}
+# armed pairs whose EMA is already past the threshold (wake only on the edge)
+_CROSSED: Set[str] = set()
+
+# long-lived event loop (on its own thread) and async client for REST snapshots
+_ASYNC_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_ASYNC_CLIENT: Optional[AsyncClient] = None
+# last response seen per client when reading the used-weight header
+_SEEN_RESPONSES: Dict[int, Any] = {}
+# keep-alive connections to Binance; covers the main thread plus the
+# concurrent async snapshot requests
+HTTP_POOL_SIZE = 8
+# how long idle connections are kept; longer than the usual check interval so
+# the next cycle's requests find a warm connection
+KEEPALIVE_SEC = 60
+
+# free balances pushed by the user data stream, keyed by asset
+BALANCE_CACHE: Dict[str, float] = {}
+BALANCE_COND = threading.Condition()
+_balance_version = 0
+# monotonic time of the last balance update, from the stream or from REST
+_balance_ts = 0.0
+# exchange time (ms) of the last account update the user stream reported
+_balance_ms = 0
+# re-sync balances over REST if nothing has updated them for this long
+BALANCE_TTL = 300
+
+# parsed config.json, reused until the file's mtime changes
+_CFG_CACHE: Dict[str, Any] = {"mtime": -1, "data": None}
+# pair specs and needed symbols derived from the cached config
+_SPEC_CACHE: Dict[str, Any] = {"mtime": -1, "specs": [], "needed": frozenset()}
+# sorted form of the needed symbols and its encoded symbols= parameter, kept
+# for the frozenset they were built from
+_SORTED_CACHE: Dict[str, Any] = {"symbols": None, "sorted": (), "param": ""}
+
+# LOT_SIZE step per symbol (0.0 when exchangeInfo has no such symbol)
+STEP_SIZES: Dict[str, float] = {}
+# wall-clock time STEP_SIZES was fetched; reset to 0 after a filter reject
+_MARKETS: Dict[str, float] = {"fetched": 0.0}
+
+# per-pair ratio EMA, when it was last updated and last rotation time (all
+# monotonic); kept in memory only.
+# A pair that has never rotated has no last_trade_ts and is always ready.
+TRIGGER_STATE: Dict[str, Dict[str, float]] = {}
+
+# last formatted timestamp and the second it was formatted for
+_NOW_CACHE: Dict[str, Any] = {"sec": -1, "text": ""}
+
+# last portfolio valuation with the balances and per-coin prices it used
+_VALUE_CACHE: Dict[str, Any] = {"stable": None, "bal": None, "px": {}, "total": 0.0}
+# relative price move that makes the cached valuation stale
+VALUE_PRICE_TOL = 0.001
+
+# hashes of what was last written, so unchanged files are not rewritten
+_LAST_STATE_HASH = None
+_LAST_STATUS_HASH = None
 
 
 def now_str() -> str:
-    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+    # the string only changes once a second; reuse it within the same second
+    sec = int(time.time())
+    if sec != _NOW_CACHE["sec"]:
+        _NOW_CACHE["sec"] = sec
+        _NOW_CACHE["text"] = time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(sec))
+    return _NOW_CACHE["text"]
 
 
 def load_config() -> Dict[str, Any]:
+    mtime = os.stat(CONFIG_FILE).st_mtime_ns
+    if mtime == _CFG_CACHE["mtime"]:
+        return _CFG_CACHE["data"]
     with open(CONFIG_FILE, "r") as f:
-        return json.load(f)
+        data = json.load(f)
+    _CFG_CACHE["mtime"] = mtime
+    _CFG_CACHE["data"] = data
+    return data
 
 
 def default_state(cfg: Dict[str, Any]) -> Dict[str, Any]:
@@ -37,52 +188,766 @@ def default_state(cfg: Dict[str, Any]) -> Dict[str, Any]:
 
 
 def load_state(cfg: Dict[str, Any]) -> Dict[str, Any]:
-    if not os.path.exists(STATE_FILE):
+    global _LAST_STATE_HASH
+    try:
+        with open(STATE_FILE, "rb") as f:
+            state = orjson.loads(f.read())
+        # what is on disk counts as saved, so an unchanged state isn't rewritten
+        _LAST_STATE_HASH = hash(encode_state(state))
+        return state
+    except FileNotFoundError:
         state = default_state(cfg)
         save_state(state)
         return state
-    with open(STATE_FILE, "r") as f:
-        return json.load(f)
+
+
+def write_atomic(path: str, data: bytes, fsync: bool = True) -> None:
+    # write next to the target and rename over it, so readers (and a restart
+    # after a crash) never see a truncated file
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def encode_state(state: Dict[str, Any]) -> bytes:
+    # compact, with sorted keys so equal states always encode to equal bytes
+    return orjson.dumps(state, option=orjson.OPT_SORT_KEYS)
 
 
 def save_state(state: Dict[str, Any]) -> None:
-    with open(STATE_FILE, "w") as f:
-        json.dump(state, f, indent=2)
+    global _LAST_STATE_HASH
+    data = encode_state(state)
+    h = hash(data)
+    if h == _LAST_STATE_HASH:
+        return
+    write_atomic(STATE_FILE, data)
+    _LAST_STATE_HASH = h
 
 
 def save_status(status: Dict[str, Any]) -> None:
-    with open(STATUS_FILE, "w") as f:
-        json.dump(status, f, indent=2)
+    global _LAST_STATUS_HASH
+    # the timestamp changes every cycle, so leave it out of the comparison
+    h = hash(orjson.dumps({k: v for k, v in status.items() if k != "timestamp"}))
+    if h == _LAST_STATUS_HASH:
+        return
+    # status.json is rewritten every cycle and only needs to be whole, not durable
+    write_atomic(STATUS_FILE, orjson.dumps(status, option=orjson.OPT_INDENT_2), fsync=False)
+    _LAST_STATUS_HASH = h
+
+
+def load_markets(client: Client, symbols: FrozenSet[str], network: str, force: bool = False) -> None:
+    # exchangeInfo is a ~1 MB download, so the step sizes are kept in
+    # markets.json, one entry per network (testnet steps differ). It is only
+    # requested for symbols not seen before, once the entry is older than
+    # MARKETS_TTL, or when forced after a filter reject.
+    try:
+        with open(MARKETS_FILE, "rb") as f:
+            cache = orjson.loads(f.read())
+    except FileNotFoundError:
+        cache = {}
+    entry = cache.get(network, {"fetched": 0.0, "steps": {}})
+
+    if (
+        force
+        or time.time() - entry["fetched"] > MARKETS_TTL
+        or not symbols <= entry["steps"].keys()
+    ):
+        steps = {}
+        for s in client.get_exchange_info()["symbols"]:
+            if s["symbol"] in symbols:
+                for flt in s["filters"]:
+                    if flt["filterType"] == "LOT_SIZE":
+                        steps[s["symbol"]] = float(flt["stepSize"])
+        for sym in symbols:
+            steps.setdefault(sym, 0.0)
+        entry = {"fetched": time.time(), "steps": steps}
+        cache[network] = entry
+        write_atomic(MARKETS_FILE, orjson.dumps(cache), fsync=False)
+
+    STEP_SIZES.clear()
+    STEP_SIZES.update(entry["steps"])
+    _MARKETS["fetched"] = entry["fetched"]
+
+
+def to_step(amount: float, step: float) -> float:
+    # round a quantity down to the symbol's LOT_SIZE step
+    if step <= 0:
+        return amount
+    return math.floor(amount / step + 1e-9) * step
 
 
 def to_symbol(coin: str, stable: str) -> str:
     return f"{coin}{stable}"
 
 
-def load_tickers(client: Client, symbols: Set[str]) -> Dict[str, float]:
-    prices: Dict[str, float] = {}
-    for sym in symbols:
+def needed_symbols_for(specs: List[PairSpec], stable: str) -> FrozenSet[str]:
+    return frozenset({
+        sys.intern(to_symbol("BTC", stable)),
+        *(p.sym_a for p in specs),
+        *(p.sym_b for p in specs),
+    })
+
+
+def load_pair_specs(cfg: Dict[str, Any]) -> Tuple[List[PairSpec], FrozenSet[str]]:
+    # only rebuilt when load_config() has picked up a changed config.json.
+    # Coin and symbol strings are interned so dict lookups keyed by them
+    # can short-circuit on identity.
+    if _SPEC_CACHE["mtime"] != _CFG_CACHE["mtime"]:
+        stable = sys.intern(cfg.get("stable_asset", "USDT"))
+        specs = [
+            PairSpec(
+                p["name"],
+                sys.intern(p["coin_a"]),
+                sys.intern(p["coin_b"]),
+                sys.intern(to_symbol(p["coin_a"], stable)),
+                sys.intern(to_symbol(p["coin_b"], stable)),
+                p["upper_ratio"],
+                p["lower_ratio"],
+                p["allocation_pct"],
+            )
+            for p in cfg["pairs"]
+        ]
+        _SPEC_CACHE["specs"] = specs
+        _SPEC_CACHE["needed"] = needed_symbols_for(specs, stable)
+        _SPEC_CACHE["mtime"] = _CFG_CACHE["mtime"]
+    return _SPEC_CACHE["specs"], _SPEC_CACHE["needed"]
+
+
+def sorted_symbols(symbols: FrozenSet[str]) -> Tuple[Tuple[str, ...], str]:
+    # the needed set only changes with config.json, so it is sorted and
+    # encoded once per change; every request then sends identical bytes
+    if symbols is not _SORTED_CACHE["symbols"]:
+        ordered = tuple(sorted(symbols))
+        _SORTED_CACHE["sorted"] = ordered
+        _SORTED_CACHE["param"] = json.dumps(ordered, separators=(",", ":"))
+        _SORTED_CACHE["symbols"] = symbols
+    return _SORTED_CACHE["sorted"], _SORTED_CACHE["param"]
+
+
+def pick_endpoint(testnet: bool) -> str:
+    # the mirrors are served from different edges; keep whichever answers
+    # /api/v3/ping fastest from here. The first ping of each pays DNS and the
+    # TLS handshake, so the second one on the warm connection is timed.
+    if testnet:
+        return ""
+    best, best_rtt = "", float("inf")
+    for ep in API_ENDPOINTS:
+        url = f"https://api{ep}.binance.com/api/v3/ping"
+        try:
+            with requests.Session() as s:
+                s.get(url, timeout=2).raise_for_status()
+                rtt = s.get(url, timeout=2).elapsed.total_seconds()
+        except requests.RequestException:
+            continue
+        if rtt < best_rtt:
+            best, best_rtt = ep, rtt
+    return best
+
+
+def tune_session(client: Client) -> None:
+    # reuse TLS connections across calls instead of handshaking per request
+    client.session.headers["Connection"] = "keep-alive"
+    client.session.headers["Keep-Alive"] = f"timeout={KEEPALIVE_SEC}, max=1000"
+    client.session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=Retry(total=3, backoff_factor=0.2),
+        ),
+    )
+
+
+def _h2_kwargs(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    # python-binance builds requests/aiohttp kwargs; httpx wants a mapping for
+    # the form body (dict keeps the signed parameter order)
+    out = {k: kwargs[k] for k in ("params", "headers", "timeout") if k in kwargs}
+    if kwargs.get("data"):
+        out["data"] = dict(kwargs["data"])
+    return out
+
+
+def _h2_result(response: Any) -> Any:
+    if not 200 <= response.status_code < 300:
+        raise BinanceAPIException(response, response.status_code, response.text)
+    try:
+        return response.json()
+    except ValueError:
+        raise BinanceRequestException(f"Invalid Response: {response.text}")
+
+
+def _h2_session(client: Any, cls: Any) -> Any:
+    # one multiplexed connection carries every outstanding request
+    return cls(
+        http2=True,
+        headers={"Accept": "application/json", "X-MBX-APIKEY": client.API_KEY},
+        limits=httpx.Limits(
+            max_keepalive_connections=HTTP_POOL_SIZE, keepalive_expiry=KEEPALIVE_SEC
+        ),
+    )
+
+
+class H2Client(Client):
+    # Client whose REST calls go over httpx/HTTP/2 instead of requests
+    _h2: Any = None
+
+    def _request(self, method, uri: str, signed: bool, force_params: bool = False, **kwargs):
+        if self._h2 is None:
+            self._h2 = _h2_session(self, httpx.Client)
+        kwargs = self._get_request_kwargs(method, signed, force_params, **kwargs)
+        self.response = self._h2.request(method.upper(), uri, **_h2_kwargs(kwargs))
+        return _h2_result(self.response)
+
+
+class AsyncH2Client(AsyncClient):
+    # AsyncClient whose REST calls go over httpx/HTTP/2 instead of aiohttp,
+    # so the gathered ticker and account requests share one connection
+    _h2: Any = None
+
+    async def _request(self, method, uri: str, signed: bool, force_params: bool = False, **kwargs):
+        if self._h2 is None:
+            self._h2 = _h2_session(self, httpx.AsyncClient)
+        kwargs = self._get_request_kwargs(method, signed, force_params, **kwargs)
+        self.response = await self._h2.request(method.upper(), uri, **_h2_kwargs(kwargs))
+        return _h2_result(self.response)
+
+    async def close_connection(self):
+        if self._h2 is not None:
+            await self._h2.aclose()
+        await super().close_connection()
+
+
+def parse_tickers(rows: List[Dict[str, str]], symbols: FrozenSet[str]) -> Dict[str, float]:
+    # rows come from one bulk get_all_tickers request covering every symbol
+    return {
+        sys.intern(t["symbol"]): float(t["price"])
+        for t in rows
+        if t["symbol"] in symbols
+    }
+
+
+def coin_prices(tickers: Dict[str, float], stable: str) -> Dict[str, float]:
+    # every needed symbol shares the stable suffix, so key the prices by coin
+    # once per cycle instead of rebuilding "<coin><stable>" for each lookup
+    n = len(stable)
+    return {sym[:-n]: px for sym, px in tickers.items() if sym.endswith(stable)}
+
+
+def portfolio_value(free_bal: Dict[str, float], coin_price: Dict[str, float], stable: str) -> float:
+    # holding is the common case: reuse the last total while the balances are
+    # unchanged and no held coin's price has moved by more than VALUE_PRICE_TOL
+    if stable == _VALUE_CACHE["stable"] and free_bal == _VALUE_CACHE["bal"] and all(
+        abs(coin_price.get(a, 0.0) - px) <= VALUE_PRICE_TOL * px
+        for a, px in _VALUE_CACHE["px"].items()
+    ):
+        return _VALUE_CACHE["total"]
+
+    # one dot product over every balance; the stable asset is worth 1 and
+    # coins without a price count as 0
+    n = len(free_bal)
+    amounts = np.fromiter(free_bal.values(), dtype=np.float64, count=n)
+    prices = np.fromiter(
+        (1.0 if a == stable else coin_price.get(a, 0.0) for a in free_bal),
+        dtype=np.float64,
+        count=n,
+    )
+    total_value_stable = float(np.dot(np.maximum(amounts, 0.0), prices))
+
+    _VALUE_CACHE["stable"] = stable
+    _VALUE_CACHE["bal"] = dict(free_bal)
+    _VALUE_CACHE["px"] = {a: px for a, px in zip(free_bal, prices.tolist()) if a != stable}
+    _VALUE_CACHE["total"] = total_value_stable
+    return total_value_stable
+
+
+def ema_weight(alpha: float, elapsed: float, interval: float) -> Any:
+    # alpha is the weight of one check interval's sample; an update after
+    # `elapsed` seconds weighs the new sample as that many intervals would, so
+    # early wakeups do not speed up the smoothing
+    return 1.0 - (1.0 - alpha) ** (elapsed / interval)
+
+
+def evaluate_pairs(
+    specs: List[PairSpec],
+    coin_price: Dict[str, float],
+    free_bal: Dict[str, float],
+    state: Dict[str, Any],
+    total_value_stable: float,
+    ema_alpha: float,
+    interval_sec: float,
+    cooldown_sec: float,
+) -> Dict[str, np.ndarray]:
+    # evaluate every pair at once on float64 arrays; specs must all be priced.
+    # Triggers fire on the smoothed ratio and only once a pair's cooldown
+    # since its last rotation has passed; each pair's EMA is updated here.
+    price_a = np.array([coin_price[p.coin_a] for p in specs], dtype=np.float64)
+    price_b = np.array([coin_price[p.coin_b] for p in specs], dtype=np.float64)
+    upper = np.array([p.upper for p in specs], dtype=np.float64)
+    lower = np.array([p.lower for p in specs], dtype=np.float64)
+    alloc = np.array([p.alloc for p in specs], dtype=np.float64)
+    bal_a = np.array([free_bal.get(p.coin_a, 0.0) for p in specs], dtype=np.float64)
+    bal_b = np.array([free_bal.get(p.coin_b, 0.0) for p in specs], dtype=np.float64)
+    current = [state.get(p.name, {"current_asset": p.coin_a})["current_asset"] for p in specs]
+    on_a = np.array([c == p.coin_a for c, p in zip(current, specs)], dtype=bool)
+    on_b = np.array([c == p.coin_b for c, p in zip(current, specs)], dtype=bool)
+
+    trig = [TRIGGER_STATE.setdefault(p.name, {}) for p in specs]
+    prev_ema = np.array([t.get("ratio_ema", np.nan) for t in trig], dtype=np.float64)
+    ema_ts = np.array([t.get("ema_ts", 0.0) for t in trig], dtype=np.float64)
+    last_trade = np.array([t.get("last_trade_ts", -math.inf) for t in trig], dtype=np.float64)
+
+    now = time.monotonic()
+    ratio = price_a / price_b
+    w = ema_weight(ema_alpha, np.maximum(now - ema_ts, 0.0), interval_sec)
+    ema = np.where(np.isnan(prev_ema), ratio, prev_ema + w * (ratio - prev_ema))
+    ready = now - last_trade > cooldown_sec
+    for t, e in zip(trig, ema.tolist()):
+        t["ratio_ema"] = e
+        t["ema_ts"] = now
+
+    value_pair = bal_a * price_a + bal_b * price_b
+    max_capital = total_value_stable * alloc
+    return {
+        "price_a": price_a,
+        "price_b": price_b,
+        "ratio": ratio,
+        "ratio_ema": ema,
+        "value_pair": value_pair,
+        "max_capital": max_capital,
+        "trade_value": np.minimum(value_pair, max_capital),
+        "trigger_up": on_a & (ema > upper) & ready,
+        "trigger_dn": on_b & (ema < lower) & ready,
+    }
+
+
+def subscribe_prices(twm: ThreadedWebsocketManager, symbols: FrozenSet[str]) -> None:
+    # only stream the symbols the pairs need; !miniTicker@arr would push
+    # every market on the exchange each second
+    if symbols == _PRICE_SOCKET["symbols"]:
+        return
+    if _PRICE_SOCKET["name"]:
+        twm.stop_socket(_PRICE_SOCKET["name"])
+    _PRICE_SOCKET["name"] = twm.start_multiplex_socket(
+        callback=_on_mini,
+        streams=[f"{sym.lower()}@miniTicker" for sym in sorted_symbols(symbols)[0]],
+    )
+    _PRICE_SOCKET["symbols"] = symbols
+
+
+def _on_mini(msg: Dict[str, Any]) -> None:
+    data = msg.get("data")
+    if data is None:
+        # the socket manager reports stream errors as a plain dict
+        logger.warning("Ticker stream error: %s", msg.get("m", msg))
+        return
+    with PRICE_LOCK:
+        PRICE_CACHE[data["s"]] = float(data["c"])
+        PRICE_TS[data["s"]] = time.monotonic()
+        _check_armed()
+
+
+def _check_armed() -> None:
+    # caller holds PRICE_LOCK
+    now = time.monotonic()
+    for name, arm in _ARMED.items():
+        price_a = PRICE_CACHE.get(arm.sym_a)
+        price_b = PRICE_CACHE.get(arm.sym_b)
+        if not price_a or not price_b:
+            continue
+        ratio = price_a / price_b
+        w = ema_weight(arm.alpha, max(now - arm.ema_ts, 0.0), arm.interval)
+        ema = arm.ema + w * (ratio - arm.ema)
+        if ema > arm.threshold if arm.fire_above else ema < arm.threshold:
+            if name not in _CROSSED:
+                _CROSSED.add(name)
+                WAKE.set()
+        else:
+            _CROSSED.discard(name)
+
+
+def arm_triggers(
+    specs: List[PairSpec],
+    state: Dict[str, Any],
+    ema_alpha: float,
+    interval_sec: float,
+    cooldown_sec: float,
+) -> None:
+    now = time.monotonic()
+    armed: Dict[str, ArmedTrigger] = {}
+    for p in specs:
+        t = TRIGGER_STATE.get(p.name, {})
+        if "ratio_ema" not in t or now - t.get("last_trade_ts", -math.inf) <= cooldown_sec:
+            continue
+        current_asset = state.get(p.name, {"current_asset": p.coin_a})["current_asset"]
+        if current_asset == p.coin_a:
+            threshold, above = p.upper, True
+        elif current_asset == p.coin_b:
+            threshold, above = p.lower, False
+        else:
+            continue
+        armed[p.name] = ArmedTrigger(
+            p.sym_a, p.sym_b, threshold, above,
+            t["ratio_ema"], t["ema_ts"], ema_alpha, interval_sec,
+        )
+    with PRICE_LOCK:
+        for name, arm in armed.items():
+            # the EMA moves every cycle; only a new pair, threshold or side re-arms
+            prev = _ARMED.get(name)
+            if prev is None or (
+                prev.sym_a, prev.sym_b, prev.threshold, prev.fire_above
+            ) != (arm.sym_a, arm.sym_b, arm.threshold, arm.fire_above):
+                _CROSSED.discard(name)
+        _ARMED.clear()
+        _ARMED.update(armed)
+
+
+def start_async_client(testnet: bool, endpoint: str) -> None:
+    global _ASYNC_LOOP, _ASYNC_CLIENT
+    _ASYNC_LOOP = asyncio.new_event_loop()
+    threading.Thread(target=_ASYNC_LOOP.run_forever, daemon=True).start()
+    _ASYNC_CLIENT = asyncio.run_coroutine_threadsafe(
+        _create_async_client(testnet, endpoint), _ASYNC_LOOP
+    ).result()
+
+
+async def _create_async_client(testnet: bool, endpoint: str) -> AsyncClient:
+    # aiohttp drops idle connections after 15 s by default, which is shorter
+    # than the check interval; keep them (and the pool) in line with requests
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=KEEPALIVE_SEC)
+    cls = AsyncH2Client if httpx else AsyncClient
+    return await cls.create(
+        API_KEY,
+        API_SECRET,
+        testnet=testnet,
+        base_endpoint=endpoint,
+        session_params={"connector": connector},
+    )
+
+
+def stop_async_client() -> None:
+    if _ASYNC_CLIENT is None:
+        return
+    asyncio.run_coroutine_threadsafe(_ASYNC_CLIENT.close_connection(), _ASYNC_LOOP).result()
+    _ASYNC_LOOP.call_soon_threadsafe(_ASYNC_LOOP.stop)
+
+
+async def _fetch_snapshot(symbols: FrozenSet[str]) -> Tuple[Dict[str, float], Dict[str, float]]:
+    rows, acct = await asyncio.gather(
+        _fetch_ticker_rows(_ASYNC_CLIENT, symbols), _ASYNC_CLIENT.get_account()
+    )
+    return parse_tickers(rows, symbols), parse_balances(acct)
+
+
+async def _fetch_ticker_rows(client: AsyncClient, symbols: FrozenSet[str]) -> List[Dict[str, str]]:
+    # a short whitelist is requested by name in one call, which keeps the
+    # response small; long ones (or an unknown symbol) take the full list
+    if len(symbols) <= BULK_SYMBOL_LIMIT:
         try:
-            t = client.get_symbol_ticker(symbol=sym)
-            prices[sym] = float(t["price"])
+            return await client.get_symbol_ticker(symbols=sorted_symbols(symbols)[1])
         except BinanceAPIException as e:
-            print(f"Ticker error for {sym}: {e}")
-        except Exception as e:
-            print(f"Unknown ticker error for {sym}: {e}")
+            logger.warning("Ticker request by symbol failed (%s), fetching all tickers", e)
+    return await client.get_all_tickers()
+
+
+def fetch_snapshot(symbols: FrozenSet[str]) -> Dict[str, float]:
+    # prices and balances over REST with both requests in flight at once;
+    # primes the caches at startup and backs up a quiet stream
+    prices, balances = asyncio.run_coroutine_threadsafe(
+        _fetch_snapshot(symbols), _ASYNC_LOOP
+    ).result()
+    now = time.monotonic()
+    with PRICE_LOCK:
+        PRICE_CACHE.update(prices)
+        PRICE_TS.update(dict.fromkeys(prices, now))
+    store_balances(balances)
     return prices
 
 
+def get_tickers(symbols: FrozenSet[str], max_age: float) -> Dict[str, float]:
+    oldest = time.monotonic() - max_age
+    with PRICE_LOCK:
+        prices = {
+            sym: PRICE_CACHE[sym]
+            for sym in symbols
+            if PRICE_TS.get(sym, -math.inf) >= oldest
+        }
+    if len(prices) == len(symbols):
+        return prices
+
+    # some symbol's stream is stale or has not pushed yet: fall back to REST
+    return fetch_snapshot(symbols)
+
+
 def load_balances(client: Client) -> Dict[str, float]:
-    acct = client.get_account()
-    balances: Dict[str, float] = {}
-    for b in acct["balances"]:
-        free_amt = float(b["free"])
-        locked_amt = float(b["locked"])
-        if free_amt > 0 or locked_amt > 0:
-            balances[b["asset"]] = free_amt
+    return parse_balances(client.get_account())
+
+
+def parse_balances(acct: Dict[str, Any]) -> Dict[str, float]:
+    # most rows are empty dust entries; reject them on the raw string
+    return {
+        b["asset"]: float(b["free"])
+        for b in acct["balances"]
+        if b["free"] != "0.00000000" or b["locked"] != "0.00000000"
+    }
+
+
+def _on_user(msg: Dict[str, Any]) -> None:
+    global _balance_version, _balance_ts, _balance_ms
+    if msg.get("e") == "error":
+        logger.warning("User stream error: %s", msg.get("m", msg))
+        return
+    if msg.get("e") != "outboundAccountPosition":
+        return
+    with BALANCE_COND:
+        for b in msg["B"]:
+            BALANCE_CACHE[b["a"]] = float(b["f"])
+        _balance_version += 1
+        _balance_ts = time.monotonic()
+        _balance_ms = max(_balance_ms, msg["u"])
+        BALANCE_COND.notify_all()
+
+
+def store_balances(balances: Dict[str, float]) -> None:
+    global _balance_version, _balance_ts
+    with BALANCE_COND:
+        BALANCE_CACHE.clear()
+        BALANCE_CACHE.update(balances)
+        _balance_version += 1
+        _balance_ts = time.monotonic()
+        BALANCE_COND.notify_all()
+
+
+def seed_balances(client: Client) -> Dict[str, float]:
+    balances = load_balances(client)
+    store_balances(balances)
     return balances
 
 
+def get_balances(client: Client) -> Dict[str, float]:
+    # the user stream only speaks when something changes, so a dropped
+    # stream looks exactly like a quiet account; re-sync once in a while
+    with BALANCE_COND:
+        if time.monotonic() - _balance_ts <= BALANCE_TTL:
+            return dict(BALANCE_CACHE)
+    return seed_balances(client)
+
+
+def wait_for_balances(client: Client, since_ms: int, timeout: float) -> Dict[str, float]:
+    # wait for the stream to report an account update at or after since_ms
+    # (an order's transactTime); fall back to REST if it doesn't
+    with BALANCE_COND:
+        if BALANCE_COND.wait_for(lambda: _balance_ms >= since_ms, timeout):
+            return dict(BALANCE_CACHE)
+    return seed_balances(client)
+
+
+def report_pair(
+    log: Any,
+    spec: PairSpec,
+    row: Tuple[float, float, float, float, float, float, bool, bool],
+    free_bal: Dict[str, float],
+    state: Dict[str, Any],
+    bal_stable: float,
+    stable: str,
+    verbose: bool,
+) -> Dict[str, Any]:
+    # log one evaluated pair and return its status.json entry; row holds the
+    # pair's evaluate_pairs results as plain floats/bools. Holding pairs are
+    # only logged when verbose, so the common case formats nothing.
+    price_a, price_b, ratio, ratio_ema, value_pair, max_capital, up, dn = row
+    name, coin_a, coin_b = spec.name, spec.coin_a, spec.coin_b
+    bal_a = free_bal.get(coin_a, 0.0)
+    bal_b = free_bal.get(coin_b, 0.0)
+    current_asset = state.get(name, {"current_asset": coin_a})["current_asset"]
+
+    next_plan = "HOLD"
+    if up:
+        next_plan = f"Switch {coin_a} -> {coin_b} (ratio ema > upper)"
+    elif dn:
+        next_plan = f"Switch {coin_b} -> {coin_a} (ratio ema < lower)"
+
+    if up or dn or verbose:
+        log(
+            f"[{name}] {coin_a}/{stable}: {price_a:.6f}, "
+            f"{coin_b}/{stable}: {price_b:.6f}, "
+            f"ratio={ratio:.4f} (ema {ratio_ema:.4f})"
+        )
+        log(
+            f"[{name}] balances: {coin_a}={bal_a:.4f}, "
+            f"{coin_b}={bal_b:.4f}, {stable}={bal_stable:.2f}"
+        )
+        log(
+            f"[{name}] pair value ~ {value_pair:.2f} {stable} "
+            f"(max allowed {max_capital:.2f} {stable})"
+        )
+        log(f"[{name}] current_asset: {current_asset}, next_plan: {next_plan}")
+        if next_plan == "HOLD":
+            log(f"[{name}] No trade condition met, holding.")
+        log("")
+
+    # status.json entry (for UI)
+    return {
+        "name": name,
+        "coin_a": coin_a,
+        "coin_b": coin_b,
+        "price_a": price_a,
+        "price_b": price_b,
+        "ratio": ratio,
+        "ratio_ema": ratio_ema,
+        "upper_ratio": spec.upper,
+        "lower_ratio": spec.lower,
+        "allocation_pct": spec.alloc,
+        "bal_a": bal_a,
+        "bal_b": bal_b,
+        "bal_stable": bal_stable,
+        "value_pair": value_pair,
+        "max_capital": max_capital,
+        "current_asset": current_asset,
+        "next_plan": next_plan,
+    }
+
+
+def sell_proceeds(order: Dict[str, Any], stable: str, estimate: float) -> float:
+    # net stable received by a filled market sell: the filled quote amount
+    # minus any commission charged in the stable asset
+    if "cummulativeQuoteQty" not in order:
+        return estimate * (1 - TAKER_FEE)
+    fee = sum(
+        float(f["commission"])
+        for f in order.get("fills", [])
+        if f["commissionAsset"] == stable
+    )
+    return float(order["cummulativeQuoteQty"]) - fee
+
+
+def execute_rotation(
+    client: Client,
+    lines: List[str],
+    name: str,
+    sell_coin: str,
+    sell_sym: str,
+    sell_price: float,
+    buy_coin: str,
+    buy_sym: str,
+    trade_value: float,
+    max_capital: float,
+    reason: str,
+    stable: str,
+    dry_run: bool,
+    free_bal: Dict[str, float],
+    state: Dict[str, Any],
+) -> Dict[str, float]:
+    # sell -> buy -> save state for one pair; returns the refreshed balances
+    if trade_value <= 0:
+        lines.append(f"[{name}] No {sell_coin} value to trade, skipping.")
+        return free_bal
+
+    sell_amount = to_step(
+        min(free_bal.get(sell_coin, 0.0), trade_value / sell_price),
+        STEP_SIZES.get(sell_sym, 0.0),
+    )
+
+    if sell_amount <= 0:
+        lines.append(f"[{name}] Computed sell amount for {sell_coin} is 0, skipping.")
+        return free_bal
+
+    lines.append(
+        f"[{name}] Trigger: {reason}, "
+        f"selling {sell_amount:.6f} {sell_coin} for {stable} "
+        f"and buying {buy_coin}."
+    )
+
+    if dry_run:
+        lines.append(f"[{name}] [DRY RUN] SELL {sell_sym} {sell_amount:.6f}")
+        lines.append(f"[{name}] [DRY RUN] Then BUY {buy_sym} with available {stable}")
+        return free_bal
+
+    try:
+        sell_order = client.order_market_sell(
+            symbol=sell_sym,
+            quantity=f"{sell_amount:.8f}",
+        )
+        lines.append(f"[{name}] Sell order: {sell_order}")
+    except BinanceAPIException as e:
+        lines.append(f"[{name}] Sell order error: {e}")
+        # -1013 covers every filter; only a LOT_SIZE reject can mean the cached
+        # step is out of date, and a trigger that keeps failing must not turn
+        # into an exchangeInfo download every cycle
+        if (
+            e.code == -1013
+            and "LOT_SIZE" in e.message
+            and time.time() - _MARKETS["fetched"] > MARKETS_RETRY
+        ):
+            _MARKETS["fetched"] = 0.0
+        return free_bal
+
+    # buy straight away with what the sell actually brought in, spending it
+    # as quoteOrderQty
+    proceeds = sell_proceeds(sell_order, stable, sell_amount * sell_price)
+    last_fill_ms = sell_order.get("transactTime", 0)
+
+    # only this sell's proceeds: free_bal may predate this cycle's earlier
+    # rotations, which already spent or received stable
+    stable_for_pair = min(proceeds, max_capital)
+    if stable_for_pair > 0:
+        try:
+            buy_order = client.order_market_buy(
+                symbol=buy_sym,
+                quoteOrderQty=f"{math.floor(stable_for_pair * 1e8) / 1e8:.8f}",
+            )
+            lines.append(f"[{name}] Buy order: {buy_order}")
+            last_fill_ms = buy_order.get("transactTime", last_fill_ms)
+        except BinanceAPIException as e:
+            lines.append(f"[{name}] Buy order error: {e}")
+    else:
+        lines.append(f"[{name}] No {stable} after sell, skipping buy.")
+
+    # balances as of the last fill, so later pairs this cycle see both legs
+    free_bal = wait_for_balances(client, last_fill_ms, 5.0)
+
+    pair_state = state.get(name, {})
+    pair_state["current_asset"] = buy_coin
+    state[name] = pair_state
+    save_state(state)
+    TRIGGER_STATE[name]["last_trade_ts"] = time.monotonic()
+    return free_bal
+
+
+def used_weight(clients: Tuple[Any, ...]) -> int:
+    # X-MBX-USED-WEIGHT-1M from each client's latest response; a response
+    # that was already read in an earlier cycle says nothing about this minute
+    weight = 0
+    for c in clients:
+        resp = getattr(c, "response", None)
+        if resp is None or _SEEN_RESPONSES.get(id(c)) is resp:
+            continue
+        _SEEN_RESPONSES[id(c)] = resp
+        weight = max(weight, int(resp.headers.get("X-MBX-USED-WEIGHT-1M", 0)))
+    return weight
+
+
+def setup_logging() -> QueueListener:
+    # the loop only enqueues records; the stdout write happens on the
+    # listener's thread
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, logging.StreamHandler())
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(message)s",
+        handlers=[QueueHandler(log_queue)],
+    )
+    # BOT_VERBOSE only opens up this module's debug output; python-binance and
+    # websockets log every received frame at DEBUG
+    if VERBOSE:
+        logger.setLevel(logging.DEBUG)
+    listener.start()
+    return listener
+
+
 def main():
     if not API_KEY or not API_SECRET:
         raise SystemExit(
@@ -90,277 +955,200 @@ def main():
             "in your environment or .env file."
         )
 
+    listener = setup_logging()
+
     cfg = load_config()
     STABLE = cfg.get("stable_asset", "USDT")
     USE_TESTNET = bool(cfg.get("use_testnet", True))
     DRY_RUN = bool(cfg.get("dry_run", True))
     CHECK_INTERVAL_SEC = int(cfg.get("check_interval_sec", 30))
 
-    client = Client(API_KEY, API_SECRET, testnet=USE_TESTNET)
-
-    state = load_state(cfg)
-
-    print("=== Multi-Pair Ratio Bot (python-binance) ===")
-    print(f"Stable asset  : {STABLE}")
-    print(f"Use testnet   : {USE_TESTNET}")
-    print(f"DRY_RUN       : {DRY_RUN}")
-    print("Pairs:")
-    for p in cfg["pairs"]:
-        print(
-            f" - {p['name']}: {p['coin_a']}/{p['coin_b']} "
-            f"(upper={p['upper_ratio']}, lower={p['lower_ratio']}, "
-            f"alloc={p['allocation_pct']})"
-        )
-    print("Initial state:", state)
-    print()
-
-    while True:
-        try:
-            # reload config each loop (so UI changes take effect)
-            cfg = load_config()
-            STABLE = cfg.get("stable_asset", "USDT")
-            USE_TESTNET = bool(cfg.get("use_testnet", True))
-            DRY_RUN = bool(cfg.get("dry_run", True))
-            CHECK_INTERVAL_SEC = int(cfg.get("check_interval_sec", 30))
-            pairs = cfg["pairs"]
-
-            print("=" * 100)
-            print(now_str())
-
-            needed_symbols: Set[str] = set()
-            needed_symbols.add(to_symbol("BTC", STABLE))
-            for pair in pairs:
-                needed_symbols.add(to_symbol(pair["coin_a"], STABLE))
-                needed_symbols.add(to_symbol(pair["coin_b"], STABLE))
-
-            tickers = load_tickers(client, needed_symbols)
-
-            btc_symbol = to_symbol("BTC", STABLE)
-            btc_price = tickers.get(btc_symbol)
-            if btc_price:
-                print(f"{btc_symbol}: {btc_price:.6f}")
-
-            free_bal = load_balances(client)
-
-            total_value_stable = 0.0
-            for asset, amount in free_bal.items():
-                if amount <= 0:
-                    continue
-                if asset == STABLE:
-                    total_value_stable += amount
-                else:
-                    sym = f"{asset}{STABLE}"
-                    px = tickers.get(sym)
-                    if px:
-                        total_value_stable += amount * px
-
-            print(f"Estimated total portfolio value: {total_value_stable:.2f} {STABLE}")
-
-            status_out: Dict[str, Any] = {
-                "timestamp": now_str(),
-                "stable_asset": STABLE,
-                "use_testnet": USE_TESTNET,
-                "dry_run": DRY_RUN,
-                "total_value_stable": total_value_stable,
-                "pairs": [],
-            }
-
-            for pair in pairs:
-                name = pair["name"]
-                coin_a = pair["coin_a"]
-                coin_b = pair["coin_b"]
-                upper = pair["upper_ratio"]
-                lower = pair["lower_ratio"]
-                alloc_pct = pair["allocation_pct"]
-
-                sym_a = to_symbol(coin_a, STABLE)
-                sym_b = to_symbol(coin_b, STABLE)
-
-                price_a = tickers.get(sym_a)
-                price_b = tickers.get(sym_b)
-
-                if price_a is None or price_b is None:
-                    print(f"[{name}] Missing ticker for {sym_a} or {sym_b}, skipping.")
-                    continue
-
-                if price_b == 0:
-                    print(f"[{name}] price_b is zero, skipping.")
-                    continue
-
-                ratio = price_a / price_b
-
-                bal_a = free_bal.get(coin_a, 0.0)
-                bal_b = free_bal.get(coin_b, 0.0)
-                bal_stable = free_bal.get(STABLE, 0.0)
+    endpoint = pick_endpoint(USE_TESTNET)
+    if httpx:
+        client = H2Client(API_KEY, API_SECRET, testnet=USE_TESTNET, base_endpoint=endpoint)
+    else:
+        client = Client(API_KEY, API_SECRET, testnet=USE_TESTNET, base_endpoint=endpoint)
+        tune_session(client)
+
+    # market metadata is loaded here, off the first cycle's critical path
+    network = "testnet" if USE_TESTNET else "mainnet"
+    load_markets(client, load_pair_specs(cfg)[1], network)
+
+    twm = ThreadedWebsocketManager(
+        api_key=API_KEY, api_secret=API_SECRET, testnet=USE_TESTNET
+    )
+    twm.start()
+    # the socket manager runs a non-daemon thread: from here on every exit,
+    # including a failed startup, has to go through twm.stop()
+    try:
+        subscribe_prices(twm, load_pair_specs(cfg)[1])
+
+        # prime both caches concurrently; the streams keep them current from here
+        start_async_client(USE_TESTNET, endpoint)
+        fetch_snapshot(load_pair_specs(cfg)[1])
+        twm.start_user_socket(callback=_on_user)
+
+        state = load_state(cfg)
+
+        # log lines are collected and written in one go rather than line by line
+        lines: List[str] = []
+        lines.append("=== Multi-Pair Ratio Bot (python-binance) ===")
+        lines.append(f"Stable asset  : {STABLE}")
+        lines.append(f"Use testnet   : {USE_TESTNET}")
+        lines.append(f"DRY_RUN       : {DRY_RUN}")
+        if not USE_TESTNET:
+            lines.append(f"REST endpoint : api{endpoint}.binance.com")
+        lines.append("Pairs:")
+        for p in cfg["pairs"]:
+            lines.append(
+                f" - {p['name']}: {p['coin_a']}/{p['coin_b']} "
+                f"(upper={p['upper_ratio']}, lower={p['lower_ratio']}, "
+                f"alloc={p['allocation_pct']})"
+            )
+        lines.append(f"Initial state: {state}")
+        lines.append("")
+        logger.info("\n".join(lines))
+
+        while True:
+            start = time.monotonic()
+            lines = []
+            try:
+                # reload config each loop (so UI changes take effect)
+                cfg = load_config()
+                STABLE = cfg.get("stable_asset", "USDT")
+                USE_TESTNET = bool(cfg.get("use_testnet", True))
+                DRY_RUN = bool(cfg.get("dry_run", True))
+                CHECK_INTERVAL_SEC = int(cfg.get("check_interval_sec", 30))
+                EMA_ALPHA = float(cfg.get("ratio_ema_alpha", 0.1))
+                COOLDOWN_SEC = float(cfg.get("trade_cooldown_sec", 300))
+                specs, needed_symbols = load_pair_specs(cfg)
+                subscribe_prices(twm, needed_symbols)
+                if (
+                    not needed_symbols <= STEP_SIZES.keys()
+                    or time.time() - _MARKETS["fetched"] > MARKETS_TTL
+                ):
+                    load_markets(client, needed_symbols, network, force=True)
+
+                lines.append("=" * 100)
+                ts_str = now_str()
+                lines.append(ts_str)
+
+                tickers = get_tickers(needed_symbols, 5 * CHECK_INTERVAL_SEC)
+                coin_price = coin_prices(tickers, STABLE)
+
+                btc_symbol = to_symbol("BTC", STABLE)
+                btc_price = tickers.get(btc_symbol)
+                if btc_price:
+                    lines.append(f"{btc_symbol}: {btc_price:.6f}")
+
+                free_bal = get_balances(client)
+
+                total_value_stable = portfolio_value(free_bal, coin_price, STABLE)
+
+                lines.append(f"Estimated total portfolio value: {total_value_stable:.2f} {STABLE}")
+
+                status_out: Dict[str, Any] = {
+                    "timestamp": ts_str,
+                    "stable_asset": STABLE,
+                    "use_testnet": USE_TESTNET,
+                    "dry_run": DRY_RUN,
+                    "total_value_stable": total_value_stable,
+                    "pairs": [],
+                }
+
+                priced: List[PairSpec] = []
+                for spec in specs:
+                    price_a = coin_price.get(spec.coin_a)
+                    price_b = coin_price.get(spec.coin_b)
+
+                    if price_a is None or price_b is None:
+                        lines.append(
+                            f"[{spec.name}] Missing ticker for {spec.sym_a} "
+                            f"or {spec.sym_b}, skipping."
+                        )
+                        continue
 
-                max_capital = total_value_stable * alloc_pct
+                    if price_b == 0:
+                        lines.append(f"[{spec.name}] price_b is zero, skipping.")
+                        continue
 
-                value_a = bal_a * price_a
-                value_b = bal_b * price_b
-                value_pair = value_a + value_b
+                    priced.append(spec)
 
-                print(
-                    f"[{name}] {coin_a}/{STABLE}: {price_a:.6f}, "
-                    f"{coin_b}/{STABLE}: {price_b:.6f}, ratio={ratio:.4f}"
-                )
-                print(
-                    f"[{name}] balances: {coin_a}={bal_a:.4f}, "
-                    f"{coin_b}={bal_b:.4f}, {STABLE}={bal_stable:.2f}"
+                ev = evaluate_pairs(
+                    priced, coin_price, free_bal, state, total_value_stable,
+                    EMA_ALPHA, CHECK_INTERVAL_SEC, COOLDOWN_SEC,
                 )
-                print(
-                    f"[{name}] pair value ~ {value_pair:.2f} {STABLE} "
-                    f"(max allowed {max_capital:.2f} {STABLE})"
+                prices_a = ev["price_a"].tolist()
+                prices_b = ev["price_b"].tolist()
+                ratio_emas = ev["ratio_ema"].tolist()
+                max_capitals = ev["max_capital"].tolist()
+                trig_up = ev["trigger_up"].tolist()
+                fired = (ev["trigger_up"] | ev["trigger_dn"]).tolist()
+                rows = zip(
+                    prices_a, prices_b, ev["ratio"].tolist(), ratio_emas,
+                    ev["value_pair"].tolist(), max_capitals, trig_up,
+                    ev["trigger_dn"].tolist(),
                 )
-
-                pair_state = state.get(name, {"current_asset": coin_a})
-                current_asset = pair_state["current_asset"]
-
-                next_plan = "HOLD"
-                if current_asset == coin_a and ratio > upper:
-                    next_plan = f"Switch {coin_a} -> {coin_b} (ratio > upper)"
-                elif current_asset == coin_b and ratio < lower:
-                    next_plan = f"Switch {coin_b} -> {coin_a} (ratio < lower)"
-
-                print(f"[{name}] current_asset: {current_asset}, next_plan: {next_plan}")
-
-                # collect for status.json (for UI)
-                status_out["pairs"].append({
-                    "name": name,
-                    "coin_a": coin_a,
-                    "coin_b": coin_b,
-                    "price_a": price_a,
-                    "price_b": price_b,
-                    "ratio": ratio,
-                    "upper_ratio": upper,
-                    "lower_ratio": lower,
-                    "allocation_pct": alloc_pct,
-                    "bal_a": bal_a,
-                    "bal_b": bal_b,
-                    "bal_stable": bal_stable,
-                    "value_pair": value_pair,
-                    "max_capital": max_capital,
-                    "current_asset": current_asset,
-                    "next_plan": next_plan,
-                })
-
-                # === EXECUTION (same as before) ===
-                if current_asset == coin_a and ratio > upper:
-                    if value_pair <= 0:
-                        print(f"[{name}] No {coin_a} value to trade, skipping.")
-                        continue
-
-                    trade_value = min(value_pair, max_capital)
-                    amount_a_to_sell = min(bal_a, trade_value / price_a)
-
-                    if amount_a_to_sell <= 0:
-                        print(f"[{name}] Computed sell amount for {coin_a} is 0, skipping.")
-                        continue
-
-                    print(
-                        f"[{name}] Trigger: ratio {ratio:.4f} > {upper}, "
-                        f"selling {amount_a_to_sell:.6f} {coin_a} for {STABLE} "
-                        f"and buying {coin_b}."
+                bal_stable = free_bal.get(STABLE, 0.0)
+                verbose = logger.isEnabledFor(logging.DEBUG)
+                add_status = status_out["pairs"].append
+
+                for spec, row in zip(priced, rows):
+                    add_status(report_pair(
+                        lines.append, spec, row, free_bal, state,
+                        bal_stable, STABLE, verbose,
+                    ))
+                holding = len(priced) - sum(fired)
+                if holding and not verbose:
+                    lines.append(f"{holding} pair(s) holding, no trigger.")
+
+                # === EXECUTION (only pairs whose trigger fired) ===
+                for i in np.flatnonzero(fired).tolist():
+                    spec = priced[i]
+                    ratio_ema = ratio_emas[i]
+
+                    if trig_up[i]:
+                        sell = (spec.coin_a, spec.sym_a, prices_a[i])
+                        buy = (spec.coin_b, spec.sym_b)
+                        reason = f"ratio ema {ratio_ema:.4f} > {spec.upper}"
+                    else:
+                        sell = (spec.coin_b, spec.sym_b, prices_b[i])
+                        buy = (spec.coin_a, spec.sym_a)
+                        reason = f"ratio ema {ratio_ema:.4f} < {spec.lower}"
+
+                    free_bal = execute_rotation(
+                        client, lines, spec.name, *sell, *buy,
+                        float(ev["trade_value"][i]), max_capitals[i], reason,
+                        STABLE, DRY_RUN, free_bal, state,
                     )
+                    lines.append("")
 
-                    if DRY_RUN:
-                        print(f"[{name}] [DRY RUN] SELL {sym_a} {amount_a_to_sell:.6f}")
-                        print(f"[{name}] [DRY RUN] Then BUY {sym_b} with available {STABLE}")
-                    else:
-                        try:
-                            sell_order = client.order_market_sell(
-                                symbol=sym_a,
-                                quantity=amount_a_to_sell,
-                            )
-                            print(f"[{name}] Sell order: {sell_order}")
-                        except BinanceAPIException as e:
-                            print(f"[{name}] Sell order error: {e}")
-                            continue
-
-                        free_bal = load_balances(client)
-                        bal_stable = free_bal.get(STABLE, 0.0)
-
-                        stable_for_pair = min(bal_stable, max_capital)
-                        if stable_for_pair > 0:
-                            amount_b_to_buy = stable_for_pair / price_b
-                            try:
-                                buy_order = client.order_market_buy(
-                                    symbol=sym_b,
-                                    quantity=amount_b_to_buy,
-                                )
-                                print(f"[{name}] Buy order: {buy_order}")
-                            except BinanceAPIException as e:
-                                print(f"[{name}] Buy order error: {e}")
-                        else:
-                            print(f"[{name}] No {STABLE} after sell, skipping buy.")
-
-                        pair_state["current_asset"] = coin_b
-                        state[name] = pair_state
-                        save_state(state)
-
-                elif current_asset == coin_b and ratio < lower:
-                    if value_pair <= 0:
-                        print(f"[{name}] No {coin_b} value to trade, skipping.")
-                        continue
+                arm_triggers(specs, state, EMA_ALPHA, CHECK_INTERVAL_SEC, COOLDOWN_SEC)
 
-                    trade_value = min(value_pair, max_capital)
-                    amount_b_to_sell = min(bal_b, trade_value / price_b)
+                # write status.json for the UI
+                save_status(status_out)
 
-                    if amount_b_to_sell <= 0:
-                        print(f"[{name}] Computed sell amount for {coin_b} is 0, skipping.")
-                        continue
+            except Exception as e:
+                lines.append(f"GLOBAL ERROR: {e!r}")
 
-                    print(
-                        f"[{name}] Trigger: ratio {ratio:.4f} < {lower}, "
-                        f"selling {amount_b_to_sell:.6f} {coin_b} for {STABLE} "
-                        f"and buying {coin_a}."
-                    )
+            logger.info("\n".join(lines))
 
-                    if DRY_RUN:
-                        print(f"[{name}] [DRY RUN] SELL {sym_b} {amount_b_to_sell:.6f}")
-                        print(f"[{name}] [DRY RUN] Then BUY {sym_a} with available {STABLE}")
-                    else:
-                        try:
-                            sell_order = client.order_market_sell(
-                                symbol=sym_b,
-                                quantity=amount_b_to_sell,
-                            )
-                            print(f"[{name}] Sell order: {sell_order}")
-                        except BinanceAPIException as e:
-                            print(f"[{name}] Sell order error: {e}")
-                            continue
-
-                        free_bal = load_balances(client)
-                        bal_stable = free_bal.get(STABLE, 0.0)
-
-                        stable_for_pair = min(bal_stable, max_capital)
-                        if stable_for_pair > 0:
-                            amount_a_to_buy = stable_for_pair / price_a
-                            try:
-                                buy_order = client.order_market_buy(
-                                    symbol=sym_a,
-                                    quantity=amount_a_to_buy,
-                                )
-                                print(f"[{name}] Buy order: {buy_order}")
-                            except BinanceAPIException as e:
-                                print(f"[{name}] Buy order error: {e}")
-                        else:
-                            print(f"[{name}] No {STABLE} after sell, skipping buy.")
-
-                        pair_state["current_asset"] = coin_a
-                        state[name] = pair_state
-                        save_state(state)
-                else:
-                    print(f"[{name}] No trade condition met, holding.")
-
-                print()
-
-            # write status.json for the UI
-            save_status(status_out)
-
-        except Exception as e:
-            print("GLOBAL ERROR:", repr(e))
-
-        time.sleep(CHECK_INTERVAL_SEC)
+            # sleep until the next absolute deadline, or until a stream
+            # callback sees a ratio cross its threshold
+            wait = start + CHECK_INTERVAL_SEC - time.monotonic()
+            weight = used_weight((client, _ASYNC_CLIENT))
+            if weight >= WEIGHT_RESERVE * WEIGHT_LIMIT_1M:
+                logger.warning(
+                    "Request weight %d/%d used this minute, backing off until the next window.",
+                    weight, WEIGHT_LIMIT_1M,
+                )
+                wait = max(wait, 60.0 - time.time() % 60.0)
+            WAKE.wait(max(0.0, wait))
+            WAKE.clear()
+    finally:
+        twm.stop()
+        stop_async_client()
+        listener.stop()
 
 
 if __name__ == "__main__":